@@ -1,9 +1,10 @@
-import re
 import urllib.parse
 import pandas as pd
 import numpy as np
 import streamlit as st
 
+from data_loader import MAIN_COLUMNS, load_and_preprocess, load_sheet_csv
+
 st.set_page_config(page_title="Beyblade Meta (Usage Frequency)", layout="wide")
 st.title("Beyblade Meta (Usage Frequency) – Fast Mode")
 
@@ -20,15 +21,7 @@ with st.sidebar:
     IMAGES_TAB = st.text_input("Images sheet tab (optional)", value="Images")
     st.caption("Sheets must be publicly viewable (Anyone with the link: Viewer).")
 
-@st.cache_data(ttl=600)
-def load_sheet_csv(url: str, tab: str) -> pd.DataFrame:
-    m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", url)
-    if not m:
-        raise ValueError("Could not parse spreadsheet ID from URL.")
-    sid = m.group(1)
-    csv_url = f"https://docs.google.com/spreadsheets/d/{sid}/gviz/tq?tqx=out:csv&sheet={urllib.parse.quote(tab)}"
-    return pd.read_csv(csv_url)
-
+@st.cache_data(ttl=600)   # also memoizes the "missing columns -> None" result
 def try_load_images(url: str, tab: str):
     try:
         df = load_sheet_csv(url, tab)
@@ -40,95 +33,12 @@ def try_load_images(url: str, tab: str):
         return None
 
 try:
-    df_raw = load_sheet_csv(SHEET_URL, MAIN_TAB)
+    df_raw, df, pre = load_and_preprocess(SHEET_URL, MAIN_TAB)
     st.success(f"Loaded {len(df_raw):,} rows from “{MAIN_TAB}”.")
 except Exception as e:
     st.error(f"Could not load sheet: {e}")
     st.stop()
 
-images_df = try_load_images(SHEET_URL, IMAGES_TAB)
-
-# -----------------------
-# PREPROCESS & PRE-AGGREGATE (CACHED)
-# -----------------------
-@st.cache_data(ttl=900)
-def preprocess_and_preaggregate(df_raw: pd.DataFrame):
-    expected = ["Event","Date","Participants","Placement","Username","Blade","Ratchet","Bit","Assist Blade"]
-    df = df_raw.copy()
-
-    # keep only needed columns if extras exist
-    keep = [c for c in expected if c in df.columns]
-    df = df[keep]
-
-    # strip spaces
-    for c in df.columns:
-        if df[c].dtype == object:
-            df[c] = df[c].astype(str).str.strip()
-
-    # types
-    if "Participants" in df.columns:
-        df["Participants"] = pd.to_numeric(df["Participants"], errors="coerce")
-    if "Placement" in df.columns:
-        df["Placement"] = pd.to_numeric(df["Placement"], errors="coerce")
-
-    # parse dates (tz-naive)
-    df["_date"] = pd.to_datetime(df.get("Date"), errors="coerce")
-    try:
-        df["_date"] = df["_date"].dt.tz_localize(None)
-    except Exception:
-        pass
-    df["_ym"] = df["_date"].dt.to_period("M")   # monthly bucket
-
-    # combo label
-    def combo_label(row):
-        blade = str(row.get("Blade", "") or "")
-        rat   = str(row.get("Ratchet", "") or "")
-        bit   = str(row.get("Bit", "") or "")
-        parts = [p for p in (blade, rat, bit) if p]
-        return " ".join(parts) if parts else "(Unknown Combo)"
-    df["_combo"] = df.apply(combo_label, axis=1) if {"Blade","Ratchet","Bit"}.issubset(df.columns) else "(Unknown Combo)"
-
-    # categories as dtype('category') for speed
-    for c in ["Blade","Ratchet","Bit","_combo","Username","Event"]:
-        if c in df.columns:
-            df[c] = df[c].astype("category")
-
-    # Pre-aggregate monthly counts for each thing type
-    pre = {}
-    for key in ["_combo","Blade","Ratchet","Bit"]:
-        if key not in df.columns: 
-            continue
-        g = df.groupby([key, "_ym"]).agg(
-            count_all=("Placement", "size"),
-            count_1st=("Placement", lambda s: int(np.nansum(s == 1))),
-            count_top3=("Placement", lambda s: int(np.nansum((s >= 1) & (s <= 3))))
-        ).reset_index()
-        pre[key] = g
-    return df, pre
-
-df, pre = preprocess_and_preaggregate(df_raw)
-
-# Optional images lookup
-blade_img = ratchet_img = bit_img = {}
-if images_df is not None:
-    tmp = images_df.copy()
-    tmp["PartType"] = tmp["PartType"].astype(str).str.strip().str.lower()
-    tmp["Name"] = tmp["Name"].astype(str).str.strip()
-    tmp["ImageURL"] = tmp["ImageURL"].astype(str).str.strip()
-    blade_img   = tmp[tmp["PartType"]=="blade"].set_index("Name")["ImageURL"].to_dict()
-    ratchet_img = tmp[tmp["PartType"]=="ratchet"].set_index("Name")["ImageURL"].to_dict()
-    bit_img     = tmp[tmp["PartType"]=="bit"].set_index("Name")["ImageURL"].to_dict()
-
-def image_for_label(label: str, mode_slug: str):
-    if not label: return None
-    if mode_slug == "blade":   return blade_img.get(label)
-    if mode_slug == "ratchet": return ratchet_img.get(label)
-    if mode_slug == "bit":     return bit_img.get(label)
-    if mode_slug == "combo":
-        blade_name = str(label).split(" ")[0]
-        return blade_img.get(blade_name)
-    return None
-
 # -----------------------
 # QUERY PARAMS + URL SYNC
 # -----------------------
@@ -142,17 +52,19 @@ def qp_read() -> dict:
         q = st.experimental_get_query_params()
         return {k:(v[0] if isinstance(v,list) and v else "") for k,v in q.items()}
 
+# read once per rerun; qp_get reuses this snapshot
+_QP_CACHE = qp_read()
+
 def qp_set(params: dict):
-    cur = {k:str(v) for k,v in qp_read().items() if k in OUR_KEYS}
+    # callers only invoke this when the params actually changed (see _qp_key below)
     tgt = {k:str(v) for k,v in params.items() if k in OUR_KEYS and v is not None}
-    if cur != tgt:
-        try:
-            st.query_params.clear(); st.query_params.update(tgt)
-        except Exception:
-            st.experimental_set_query_params(**tgt)
+    try:
+        st.query_params.clear(); st.query_params.update(tgt)
+    except Exception:
+        st.experimental_set_query_params(**tgt)
 
 def qp_get(name, default):
-    v = qp_read().get(name, default)
+    v = _QP_CACHE.get(name, default)
     return default if v in (None, "") else str(v)
 
 # defaults: mode=combo, finish=top3, period=6m, view=home
@@ -165,39 +77,49 @@ qp_item   = urllib.parse.unquote(qp_get("item", ""))
 # -----------------------
 # FILTER UI
 # -----------------------
-view_map = {
+VIEW_MAP = {
     "Top combos": ("_combo", "Combo", "combo"),
     "Blades":     ("Blade",  "Blade", "blade"),
     "Ratchets":   ("Ratchet","Ratchet","ratchet"),
     "Bits":       ("Bit",    "Bit",   "bit"),
 }
-finish_options = ["Only 1st", "1st - 3rd", "All"]
-period_options = ["Past month", "Past 3 months", "Past 6 months"]
-
-default_view   = {"combo":"Top combos","blade":"Blades","ratchet":"Ratchets","bit":"Bits"}.get(qp_mode, "Top combos")
-default_finish = {"1st":"Only 1st","top3":"1st - 3rd","all":"All"}.get(qp_finish, "1st - 3rd")
-default_period = {"1m":"Past month","3m":"Past 3 months","6m":"Past 6 months"}.get(qp_period, "Past 6 months")
+VIEW_OPTIONS   = list(VIEW_MAP.keys())
+MODE_TO_COL    = {slug: col for col, _, slug in VIEW_MAP.values()}
+VIEW_BY_MODE   = {slug: label for label, (_, _, slug) in VIEW_MAP.items()}
+FINISH_SLUGS   = {"Only 1st":"1st","1st - 3rd":"top3","All":"all"}
+PERIOD_SLUGS   = {"Past month":"1m","Past 3 months":"3m","Past 6 months":"6m"}
+FINISH_OPTIONS = list(FINISH_SLUGS.keys())
+PERIOD_OPTIONS = list(PERIOD_SLUGS.keys())
+FINISH_BY_SLUG = {v: k for k, v in FINISH_SLUGS.items()}
+PERIOD_BY_SLUG = {v: k for k, v in PERIOD_SLUGS.items()}
+MONTHS_BACK    = {"1m":1,"3m":3,"6m":6}
+METRIC_COL     = {"all":"count_all","1st":"count_1st","top3":"count_top3"}
+TOP_N          = 200   # leaderboard rows to render
+
+default_view   = VIEW_BY_MODE.get(qp_mode, "Top combos")
+default_finish = FINISH_BY_SLUG.get(qp_finish, "1st - 3rd")
+default_period = PERIOD_BY_SLUG.get(qp_period, "Past 6 months")
 
 col1, col2, col3 = st.columns(3)
 with col1:
     try:
-        view_label = st.segmented_control("View", options=list(view_map.keys()), default=default_view)
+        view_label = st.segmented_control("View", options=VIEW_OPTIONS, default=default_view)
     except Exception:
-        view_label = st.selectbox("View", list(view_map.keys()), index=list(view_map.keys()).index(default_view))
+        view_label = st.selectbox("View", VIEW_OPTIONS, index=VIEW_OPTIONS.index(default_view))
 with col2:
     try:
-        finish_label = st.segmented_control("Finishes", options=finish_options, default=default_finish)
+        finish_label = st.segmented_control("Finishes", options=FINISH_OPTIONS, default=default_finish)
     except Exception:
-        finish_label = st.selectbox("Finishes", finish_options, index=finish_options.index(default_finish))
+        finish_label = st.selectbox("Finishes", FINISH_OPTIONS, index=FINISH_OPTIONS.index(default_finish))
 with col3:
     try:
-        period_label = st.segmented_control("Date range", options=period_options, default=default_period)
+        period_label = st.segmented_control("Date range", options=PERIOD_OPTIONS, default=default_period)
     except Exception:
-        period_label = st.selectbox("Date range", period_options, index=period_options.index(default_period))
+        period_label = st.selectbox("Date range", PERIOD_OPTIONS, index=PERIOD_OPTIONS.index(default_period))
 
-finish_slug = {"Only 1st":"1st","1st - 3rd":"top3","All":"all"}[finish_label]
-period_slug = {"Past month":"1m","Past 3 months":"3m","Past 6 months":"6m"}[period_label]
-group_col, thing_label, mode_slug = view_map[view_label]
+finish_slug = FINISH_SLUGS[finish_label]
+period_slug = PERIOD_SLUGS[period_label]
+group_col, thing_label, mode_slug = VIEW_MAP[view_label]
 
 # Perf knobs
 c1, c2 = st.columns(2)
@@ -206,38 +128,63 @@ with c1:
 with c2:
     show_images = st.toggle("Show images", value=False, help="Turn on if you want thumbnails; off is faster.")
 
+# Optional images: only fetched and indexed when thumbnails are switched on
+images_df = try_load_images(SHEET_URL, IMAGES_TAB) if show_images and IMAGES_TAB.strip() else None
+blade_img = ratchet_img = bit_img = {}
+if images_df is not None:
+    tmp = images_df[["PartType","Name","ImageURL"]].astype(str)
+    tmp = tmp.apply(lambda s: s.str.strip())   # per column, not per row
+    tmp["PartType"] = tmp["PartType"].str.lower()
+    # one partition by part type instead of a boolean scan per type
+    by_type = {k: g.set_index("Name")["ImageURL"].to_dict() for k, g in tmp.groupby("PartType", sort=False)}
+    blade_img   = by_type.get("blade", {})
+    ratchet_img = by_type.get("ratchet", {})
+    bit_img     = by_type.get("bit", {})
+
 # -----------------------
-# CUT-OFF MONTH (as Period) & AGG PICK
+# CUT-OFF MONTH (as year*12 + month) & AGG PICK
 # -----------------------
-months_back = {"1m":1,"3m":3,"6m":6}[period_slug]
-cutoff_period = (pd.Timestamp.now(tz=None) - pd.DateOffset(months=months_back)).to_period("M")
+months_back = MONTHS_BACK[period_slug]
+cutoff_ts = pd.Timestamp.now(tz=None) - pd.DateOffset(months=months_back)
+cutoff_ym = cutoff_ts.year * 12 + cutoff_ts.month
 
-metric_col = {"all":"count_all","1st":"count_1st","top3":"count_top3"}[finish_slug]
+metric_col = METRIC_COL[finish_slug]
 pre_tbl = pre.get(group_col)
 if pre_tbl is None:
     st.info("No data for this view.")
     st.stop()
 
 # Slice aggregated table by month >= cutoff, then sum Usage by label
-view_slice = pre_tbl[ pre_tbl["_ym"].notna() & (pre_tbl["_ym"] >= cutoff_period) ].copy()
-agg = (view_slice.groupby(group_col, as_index=False)[metric_col]
+view_slice = pre_tbl[ pre_tbl["_ym"] >= cutoff_ym ]
+agg = (view_slice.groupby(group_col, as_index=False, observed=True, sort=False)[metric_col]
        .sum()
        .rename(columns={group_col: thing_label, metric_col: "Usage"})
       )
 # Filter by min usage & sort
 agg = agg[agg["Usage"] >= min_usage].sort_values(["Usage", thing_label], ascending=[False, True])
 
+# Share is of the whole leaderboard, but only the top rows get formatted/linked
 total_usage = int(agg["Usage"].sum()) or 1
-agg["Share"] = (agg["Usage"] / total_usage * 100).round(1).astype(str) + "%"
-
-# Detail link + (optional) image
-def mk_detail_link(val: str) -> str:
-    return f"?view=detail&mode={urllib.parse.quote(mode_slug)}&item={urllib.parse.quote(str(val))}&finish={finish_slug}&period={period_slug}"
-
-agg["Detail"] = agg[thing_label].astype(str).map(mk_detail_link)
+n_labels = len(agg)
+agg = agg.head(TOP_N).copy()
+share = agg["Usage"].to_numpy() * (100.0 / total_usage)
+agg["Share"] = np.char.add(np.char.mod("%.1f", share), "%")
+
+# Detail link + (optional) image; only the item needs quoting, the rest is constant
+link_prefix = f"?view=detail&mode={urllib.parse.quote(mode_slug)}&item="
+link_suffix = f"&finish={finish_slug}&period={period_slug}"
+labels = agg[thing_label].astype(str)
+quoted = {u: urllib.parse.quote(u) for u in labels.unique()}   # quote each distinct label once
+# astype(object): an empty leaderboard maps to float64, which can't be concatenated with str
+agg["Detail"] = link_prefix + labels.map(quoted).astype(object) + link_suffix
 
 if show_images and images_df is not None:
-    agg["Image"] = agg[thing_label].astype(str).map(lambda v: image_for_label(v, mode_slug))
+    # only the (top-N) leaderboard labels are looked up, via a plain hash map
+    if mode_slug == "combo":
+        # combos show the blade's picture
+        agg["Image"] = labels.str.split(" ", n=1).str[0].map(blade_img)
+    else:
+        agg["Image"] = labels.map({"blade": blade_img, "ratchet": ratchet_img, "bit": bit_img}[mode_slug])
     # put image first
     cols = ["Image", thing_label, "Usage", "Share", "Detail"]
     agg = agg[cols]
@@ -250,13 +197,18 @@ else:
 effective_view = "detail" if (qp_view == "detail" and qp_item) else "home"
 params_to_set = {"view": effective_view, "mode": mode_slug, "finish": finish_slug, "period": period_slug}
 if effective_view == "detail": params_to_set["item"] = qp_item
-qp_set(params_to_set)
+qp_key = (effective_view, mode_slug, finish_slug, period_slug, qp_item if effective_view == "detail" else "")
+if st.session_state.get("_qp_key") != qp_key:
+    qp_set(params_to_set)
+    st.session_state["_qp_key"] = qp_key
 
 # -----------------------
 # RENDER
 # -----------------------
 if effective_view == "home":
     st.subheader("Leaderboard (pre-aggregated; instant)")
+    if n_labels > TOP_N:
+        st.caption(f"Showing top {TOP_N} of {n_labels:,}")
     column_config = {"Detail": st.column_config.LinkColumn("Detail", display_text="View")}
     if show_images and images_df is not None:
         column_config["Image"] = st.column_config.ImageColumn("Pic", width="small")
@@ -270,26 +222,21 @@ if effective_view == "home":
 else:
     st.markdown(f"### Details: **{qp_item}** _(by {thing_label[:-1] if thing_label.endswith('s') else thing_label}; {finish_label}, {period_label})_")
 
-    # Build a fast mask using precomputed month & raw columns
-    mask = df["_ym"].notna() & (df["_ym"] >= cutoff_period)
+    # Build a fast mask from the precomputed month index & placement indicators
+    # (no in-place &=: to_numpy() can hand back a read-only view under copy-on-write)
+    base_mask = df["_ym"].to_numpy() >= cutoff_ym
     if finish_slug == "1st":
-        mask &= (df["Placement"] == 1)
+        base_mask = base_mask & df["_is_1st"].to_numpy(dtype=bool)
     elif finish_slug == "top3":
-        mask &= df["Placement"].between(1, 3, inclusive="both")
+        base_mask = base_mask & df["_is_top3"].to_numpy(dtype=bool)
 
-    if mode_slug == "combo":
-        mask &= df["_combo"].astype(str).eq(qp_item)
-    elif mode_slug == "blade" and "Blade" in df.columns:
-        mask &= df["Blade"].astype(str).eq(qp_item)
-    elif mode_slug == "ratchet" and "Ratchet" in df.columns:
-        mask &= df["Ratchet"].astype(str).eq(qp_item)
-    elif mode_slug == "bit" and "Bit" in df.columns:
-        mask &= df["Bit"].astype(str).eq(qp_item)
-    else:
+    item_col = MODE_TO_COL.get(mode_slug)
+    if item_col is None or item_col not in df.columns:
         st.error("Unknown mode or missing column.")
         st.stop()
+    mask = base_mask & (df[item_col] == qp_item).to_numpy()
 
-    sub = df.loc[mask].copy()
+    sub = df.iloc[mask]   # read-only from here on, no copy needed
     if sub.empty:
         st.info("No rows matched under the current filters.")
         st.link_button("← Back to Leaderboard", "?view=home")
@@ -301,11 +248,13 @@ else:
         c2.metric("Share (of leaderboard total)", f"{share:.1f}%")
         st.link_button("← Back to Leaderboard", "?view=home")
 
-        show_cols = [c for c in ["Event","Date","Participants","Placement","Username","Blade","Ratchet","Bit","Assist Blade"] if c in sub.columns]
-        sub = sub.sort_values(["_date","Event"], ascending=[False, True])
+        show_cols = [c for c in MAIN_COLUMNS if c in sub.columns]
         st.markdown("#### Rows that make up this stat")
         st.dataframe(sub[show_cols], use_container_width=True, hide_index=True)
 
 # Optional raw data peek
-with st.expander("See raw data"):
-    st.dataframe(df_raw, use_container_width=True)
+# (an expander body still runs while collapsed, so gate on a checkbox instead)
+if st.checkbox("Show raw data", value=False):
+    n_raw = max(len(df_raw), 1)
+    raw_rows = st.number_input("Rows to show", min_value=1, max_value=n_raw, value=min(1000, n_raw), step=500)
+    st.dataframe(df_raw.head(int(raw_rows)), use_container_width=True)
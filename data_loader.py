@@ -0,0 +1,237 @@
+import csv
+import hashlib
+import io
+import json
+import re
+import tempfile
+import time
+import urllib.parse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import requests
+import streamlit as st
+
+# Shared by every page of the app: keeping the cached loaders (load_sheet_csv,
+# load_and_preprocess) in one module means st.cache_data sees a single function
+# per loader and pages reuse the same cache entries.
+
+def sheet_csv_url(url: str, tab: str) -> str:
+    m = re.search(r"/spreadsheets/d/([a-zA-Z0-9-_]+)", url)
+    if not m:
+        raise ValueError("Could not parse spreadsheet ID from URL.")
+    sid = m.group(1)
+    return f"https://docs.google.com/spreadsheets/d/{sid}/gviz/tq?tqx=out:csv&sheet={urllib.parse.quote(tab)}"
+
+# columns the app reads from the main tab; anything else in the sheet is skipped at parse time
+MAIN_COLUMNS = ["Event","Date","Participants","Placement","Username","Blade","Ratchet","Bit","Assist Blade"]
+
+# explicit column types for the main tab so the parser skips type inference for these.
+# Dictionary-encoded strings come out of to_pandas() as pandas categoricals.
+# Username is left out: it is near-unique per row, so a category buys nothing.
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+MAIN_DTYPES = {"Blade":_CATEGORY,"Ratchet":_CATEGORY,"Bit":_CATEGORY,"Event":_CATEGORY}
+
+def fetch_csv(csv_url: str, etag: str = None, last_modified: str = None, dtype: dict = None, usecols: list = None):
+    """Conditional GET; returns (df, headers), with df=None on a 304."""
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    r = requests.get(csv_url, headers=headers, timeout=15)
+    if r.status_code == 304:
+        return None, r.headers
+    r.raise_for_status()
+    data = r.content
+    include = None
+    if usecols is not None:
+        # project at parse time; intersect with the header so absent columns are tolerated
+        header_line = data.split(b"\n", 1)[0].decode("utf-8-sig").rstrip("\r")
+        header = next(csv.reader([header_line]), [])
+        include = [c for c in header if c in usecols]
+    # pyarrow's reader parses on all cores; empty cells become nulls like pandas' NaN
+    opts = pacsv.ConvertOptions(column_types=dtype or {}, strings_can_be_null=True,
+                                include_columns=include)
+    tbl = pacsv.read_csv(io.BytesIO(data), convert_options=opts)
+    return tbl.to_pandas(date_as_object=False), r.headers
+
+@st.cache_data(ttl=600)
+def load_sheet_csv(url: str, tab: str) -> pd.DataFrame:
+    df, _ = fetch_csv(sheet_csv_url(url, tab))
+    return df
+
+# -----------------------
+# PREPROCESS & PRE-AGGREGATE (CACHED)
+# -----------------------
+@st.cache_data(ttl=900)
+def preprocess_and_preaggregate(df_raw: pd.DataFrame):
+    # keep only needed columns if extras exist (copy just those, not the whole sheet)
+    keep = [c for c in MAIN_COLUMNS if c in df_raw.columns]
+    df = df_raw.loc[:, keep].copy()
+
+    # strip spaces on the text columns used downstream (NaN stays NaN)
+    for c in ("Event","Date","Username","Blade","Ratchet","Bit","Assist Blade"):
+        if c not in df.columns:
+            continue
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            # only the categories table needs stripping, not every row
+            df[c] = df[c].map(str.strip, na_action="ignore").astype("category")
+        elif pd.api.types.is_string_dtype(df[c].dtype):   # object, or pandas 3's str
+            df[c] = df[c].str.strip()
+
+    # types
+    if "Username" in df.columns:
+        # high cardinality: Arrow-backed strings beat category here
+        df["Username"] = df["Username"].astype("string[pyarrow]")
+    if "Participants" in df.columns:
+        df["Participants"] = pd.to_numeric(df["Participants"], errors="coerce", downcast="integer")
+    if "Placement" in df.columns:
+        df["Placement"] = pd.to_numeric(df["Placement"], errors="coerce", downcast="integer")
+        df["_is_1st"]  = df["Placement"].eq(1).astype(np.int32)
+        df["_is_top3"] = df["Placement"].between(1, 3, inclusive="both").fillna(False).astype(np.int32)
+
+    # parse dates (tz-naive); Sheets exports M/D/YYYY, so try that fast path first
+    if "Date" in df.columns:
+        raw = df["Date"]
+        dt = pd.to_datetime(raw, format="%m/%d/%Y", errors="coerce")
+        # blanks stay NaT; only non-empty cells the fast path missed are re-parsed,
+        # per element, so minority formats aren't dropped from every period window
+        leftover = dt.isna() & raw.notna()
+        if leftover.any():
+            rest = pd.to_datetime(raw[leftover], format="mixed", errors="coerce", utc=True).dt.tz_localize(None)
+            dt = dt.fillna(rest)
+        df["_date"] = dt
+    else:
+        df["_date"] = pd.NaT
+    # monthly bucket as a plain int (year*12 + month); NaT -> -1
+    ym = (df["_date"].dt.year * 12 + df["_date"].dt.month).astype("Int32")
+    df["_ym"] = ym.fillna(-1).astype("int32")
+
+    # combo label (vectorized: one string pass instead of a per-row apply)
+    if {"Blade","Ratchet","Bit"}.issubset(df.columns):
+        b  = df["Blade"].astype(object).fillna("").astype(str).str.strip()
+        r  = df["Ratchet"].astype(object).fillna("").astype(str).str.strip()
+        bt = df["Bit"].astype(object).fillna("").astype(str).str.strip()
+        combo = (b + " " + r + " " + bt).str.replace(r"\s+", " ", regex=True).str.strip()
+        df["_combo"] = combo.mask(combo.eq(""), "(Unknown Combo)").astype("category")
+    else:
+        df["_combo"] = pd.Series("(Unknown Combo)", index=df.index, dtype="category")
+
+    # newest first, then by event name; boolean masks keep this order, so the
+    # detail view never has to sort again
+    sort_cols = [c for c in ("_date","Event") if c in df.columns]
+    df = df.sort_values(sort_cols, ascending=[c == "Event" for c in sort_cols], kind="stable",
+                        key=lambda s: s.astype(object) if s.name == "Event" else s).reset_index(drop=True)
+
+    # Pre-aggregate monthly counts for each thing type
+    pre = {}
+    for key in ["_combo","Blade","Ratchet","Bit"]:
+        if key not in df.columns: 
+            continue
+        g = df.groupby([key, "_ym"], observed=True, sort=False).agg(
+            count_all=("_is_1st", "size"),
+            count_1st=("_is_1st", "sum"),
+            count_top3=("_is_top3", "sum")
+        ).reset_index()
+        pre[key] = g
+    return df, pre
+
+# -----------------------
+# DISK CACHE (survives process restarts)
+# -----------------------
+DISK_CACHE_TTL = 900   # seconds before we revalidate against the sheet
+CACHE_VERSION = 2      # bump whenever preprocess_and_preaggregate's output changes shape
+
+def _disk_cache_dir(csv_url: str) -> Path:
+    key = hashlib.sha256(f"v{CACHE_VERSION}:{csv_url}".encode()).hexdigest()[:16]
+    return Path(tempfile.gettempdir()) / f"bb_{key}"
+
+def _dtype_name(dtype) -> str:
+    # str() of a pd.NA-backed StringDtype is just "string"; keep the storage so
+    # string[pyarrow] doesn't come back from Parquet as string[python]
+    if str(dtype) == "string":
+        return f"string[{dtype.storage}]"
+    return str(dtype)
+
+def _frame_schema(frame: pd.DataFrame) -> list:
+    return [[c, _dtype_name(t)] for c, t in frame.dtypes.items()]
+
+def _restore_schema(frame: pd.DataFrame, schema: list) -> pd.DataFrame:
+    """Cast columns back to the dtypes recorded at write time; raise if they still differ."""
+    for c, name in schema:
+        if _dtype_name(frame[c].dtype) != name:
+            frame[c] = frame[c].astype(name)
+    if _frame_schema(frame) != schema:
+        raise ValueError("Disk cache does not match the preprocessing schema.")
+    return frame
+
+def _read_disk_cache(cache_dir: Path, meta: dict):
+    schemas = meta["schemas"]
+    df_raw = _restore_schema(pd.read_parquet(cache_dir / "raw.parquet"), schemas["raw"])
+    df = _restore_schema(pd.read_parquet(cache_dir / "df.parquet"), schemas["df"])
+    pre = {k: _restore_schema(pd.read_parquet(cache_dir / f"pre_{i}.parquet"), schemas["pre"][i])
+           for i, k in enumerate(meta["pre_keys"])}
+    return df_raw, df, pre
+
+def _write_disk_cache(cache_dir: Path, df_raw, df, pre, headers):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    df_raw.to_parquet(cache_dir / "raw.parquet", compression="zstd")
+    df.to_parquet(cache_dir / "df.parquet", compression="zstd")
+    for i, g in enumerate(pre.values()):
+        g.to_parquet(cache_dir / f"pre_{i}.parquet", compression="zstd")
+    # meta goes last so a half-written cache is never picked up
+    meta = {
+        "cache_version": CACHE_VERSION,
+        "fetch_time": time.time(),
+        "sheet_etag": headers.get("ETag") if headers else None,
+        "last_modified": headers.get("Last-Modified") if headers else None,
+        "pre_keys": list(pre.keys()),
+        # dtypes as preprocess_and_preaggregate produced them; reads are checked against these
+        "schemas": {
+            "raw": _frame_schema(df_raw),
+            "df":  _frame_schema(df),
+            "pre": [_frame_schema(g) for g in pre.values()],
+        },
+    }
+    (cache_dir / "meta.json").write_text(json.dumps(meta))
+
+@st.cache_data(ttl=600)
+def load_and_preprocess(url: str, tab: str):
+    csv_url = sheet_csv_url(url, tab)
+    cache_dir = _disk_cache_dir(csv_url)
+    meta_path = cache_dir / "meta.json"
+    try:
+        meta = json.loads(meta_path.read_text())
+    except Exception:
+        meta = None
+    if meta is not None and meta.get("cache_version") != CACHE_VERSION:
+        meta = None   # written by an older preprocessing step; rebuild
+
+    df_raw, headers = None, None
+    if meta is not None:
+        if time.time() - meta["fetch_time"] >= DISK_CACHE_TTL:
+            df_raw, headers = fetch_csv(csv_url, meta.get("sheet_etag"), meta.get("last_modified"),
+                                        dtype=MAIN_DTYPES, usecols=MAIN_COLUMNS)
+            if df_raw is None:   # 304: sheet unchanged, refresh the timestamp
+                meta["fetch_time"] = time.time()
+                try:
+                    meta_path.write_text(json.dumps(meta))
+                except Exception:
+                    pass   # best-effort, like _write_disk_cache
+        if df_raw is None:
+            try:
+                return _read_disk_cache(cache_dir, meta)
+            except Exception:
+                pass
+
+    if df_raw is None:
+        df_raw, headers = fetch_csv(csv_url, dtype=MAIN_DTYPES, usecols=MAIN_COLUMNS)
+    df, pre = preprocess_and_preaggregate(df_raw)
+    try:
+        _write_disk_cache(cache_dir, df_raw, df, pre, headers)
+    except Exception:
+        pass   # disk cache is best-effort
+    return df_raw, df, pre